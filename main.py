@@ -1,31 +1,101 @@
 import os
+import re
+import asyncio
+import hmac
 import time
-import random
+import secrets
+from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Optional
 from fastapi import FastAPI, HTTPException, Depends, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, EmailStr
+from bson import ObjectId
+from bson.errors import InvalidId
 from database import db, create_document
 from schemas import Userprofile, Message, Matchrequest, Otp
+import orjson
 import stripe
-from jose import jwt, JWTError
+import redis.asyncio as redis_async
+from fastapi.concurrency import run_in_threadpool
+import jwt
+from jwt.exceptions import InvalidTokenError as JWTError
 
 # Stripe setup
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY", "")
+# Persistent pooled HTTP client so checkout calls reuse TCP/TLS
+# connections instead of paying a fresh handshake per request.
+stripe.default_http_client = stripe.http_client.RequestsClient()
+# Reference a pre-created Price when configured instead of resending
+# inline price_data on every checkout.
+STRIPE_PRICE_ID = os.getenv("STRIPE_PRICE_ID")
+
+FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
+CHECKOUT_SUCCESS_URL = FRONTEND_URL + "/success?session_id={CHECKOUT_SESSION_ID}"
+CHECKOUT_CANCEL_URL = FRONTEND_URL + "/"
+
+# Redis cache setup (optional, like the database)
+_redis_url = os.getenv("REDIS_URL")
+redis = redis_async.from_url(_redis_url, decode_responses=True) if _redis_url else None
+PROFILE_CACHE_TTL = 300  # seconds
 
 # Auth config
 SECRET_KEY = os.getenv("AUTH_SECRET_KEY", "super-secret-key-change-me")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_SECONDS = 60 * 60 * 24 * 7  # 7 days
 
-app = FastAPI(title="ASN Location Swap API")
+SEARCH_FIELDS = ("desired_region", "current_region", "agency")
 
+# Detail view returns the full document minus internal search artifacts.
+PROFILE_DETAIL_PROJECTION = {"_id": 0, **{field + "_lc": 0 for field in SEARCH_FIELDS}}
+
+# List views only need the summary fields; detail fields (nip, position,
+# grade, subscription status) stay behind /api/profile/{email}.
+PROFILE_LIST_PROJECTION = {
+    "_id": 0,
+    "email": 1,
+    "name": 1,
+    "agency": 1,
+    "current_region": 1,
+    "desired_region": 1,
+    "is_verified": 1,
+}
+
+# orjson serializes the list-heavy search/admin responses several times
+# faster than stdlib json.
+app = FastAPI(title="ASN Location Swap API", default_response_class=ORJSONResponse)
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    if db is None:
+        return
+    for field in SEARCH_FIELDS:
+        # Plain B-tree on the lowercased copy serves both $eq and
+        # anchored-prefix search.
+        await db["userprofile"].create_index(field + "_lc")
+    await db["userprofile"].create_index("email", unique=True)
+    # One seek per conversation instead of a two-branch $or merge; _id as
+    # the second component matches get_history's keyset sort, traversed
+    # backward for descending pages.
+    await db["message"].create_index([("conversation_key", 1), ("_id", 1)])
+    await db["message"].create_index("from_email")
+    await db["message"].create_index("to_email")
+    await db["otp"].create_index([("email", 1), ("created_at", -1)])
+    # TTL on created_at (a BSON date set by create_document) expires OTP
+    # docs automatically after their 10-minute lifetime.
+    await db["otp"].create_index("created_at", expireAfterSeconds=600)
+
+# Fixed origin list + max_age lets browsers cache preflights for a day
+# instead of re-sending OPTIONS before every credentialed request.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[FRONTEND_URL],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "DELETE"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
 )
 
 
@@ -35,7 +105,7 @@ class CheckoutSessionRequest(BaseModel):
 
 
 class ProfileCreateRequest(Userprofile):
-    pass
+    model_config = ConfigDict(str_strip_whitespace=True, frozen=True)
 
 
 class ProfileUpdateRequest(BaseModel):
@@ -49,6 +119,8 @@ class ProfileUpdateRequest(BaseModel):
 
 
 class SendMessageRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, frozen=True)
+
     to_email: EmailStr
     content: str
 
@@ -69,6 +141,41 @@ def create_access_token(email: str) -> str:
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def conversation_key(a: str, b: str) -> str:
+    """Order-independent key identifying the chat between two users."""
+    return "|".join(sorted([a, b]))
+
+
+def stream_json_array(cursor, key: str) -> StreamingResponse:
+    """Stream a Motor cursor as {"<key>": [...]} without buffering it all."""
+    async def gen():
+        yield b'{"' + key.encode() + b'":['
+        first = True
+        async for doc in cursor:
+            yield (b"" if first else b",") + orjson.dumps(doc)
+            first = False
+        yield b"]}"
+
+    return StreamingResponse(gen(), media_type="application/json")
+
+
+async def invalidate_profile_cache(email: str):
+    if redis is not None:
+        await redis.delete(f"profile:{email}")
+
+
+@lru_cache(maxsize=10_000)
+def _decode_token(token: str) -> tuple:
+    """Decode and verify a JWT, returning (sub, exp).
+
+    Cached per-process so repeat requests from the same client skip the
+    HMAC + base64 + JSON work; callers must still check exp, since a
+    cached hit may have expired after it was first validated.
+    """
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    return payload.get("sub"), int(payload.get("exp", 0))
+
+
 def get_current_user(authorization: Optional[str] = Header(None)) -> Optional[str]:
     if not authorization:
         raise HTTPException(status_code=401, detail="Missing Authorization header")
@@ -76,8 +183,10 @@ def get_current_user(authorization: Optional[str] = Header(None)) -> Optional[st
         scheme, token = authorization.split(" ", 1)
         if scheme.lower() != "bearer":
             raise ValueError("Invalid auth scheme")
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload.get("sub")
+        sub, exp = _decode_token(token)
+        if exp and exp <= int(time.time()):
+            raise ValueError("Token expired")
+        return sub
     except (ValueError, JWTError):
         raise HTTPException(status_code=401, detail="Invalid or expired token")
 
@@ -87,8 +196,18 @@ def root():
     return {"message": "ASN Location Swap API running"}
 
 
+# /test may back a load-balancer liveness probe; cache it briefly so
+# probe traffic doesn't hit Mongo on every poll.
+_HEALTH_PROBE_TTL = 5  # seconds
+_last_probe = (0.0, None)
+
+
 @app.get("/test")
-def test_database():
+async def test_database():
+    global _last_probe
+    probed_at, cached = _last_probe
+    if cached is not None and time.monotonic() - probed_at < _HEALTH_PROBE_TTL:
+        return cached
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -105,7 +224,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -117,33 +236,35 @@ def test_database():
 
     response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
     response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    _last_probe = (time.monotonic(), response)
     return response
 
 
 # ----------------- Auth (OTP) -----------------
 @app.post("/api/auth/request-otp")
-def request_otp(req: OTPRequest):
+async def request_otp(req: OTPRequest):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    code = f"{random.randint(0, 999999):06d}"
+    code = f"{secrets.randbelow(1_000_000):06d}"
     expires_at = int(time.time()) + 600  # 10 minutes
-    db["otp"].delete_many({"email": req.email})
-    create_document("otp", {"email": req.email, "code": code, "purpose": "login", "expires_at": expires_at})
+    await create_document("otp", {"email": req.email, "code": code, "purpose": "login", "expires_at": expires_at})
     # In production, send the code via email provider. For dev/demo, we return it.
     return {"status": "ok", "message": "OTP generated. Check your email.", "debug_code": code}
 
 
 @app.post("/api/auth/verify-otp")
-def verify_otp(req: OTPVerify):
+async def verify_otp(req: OTPVerify):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    rec = db["otp"].find_one({"email": req.email, "code": req.code})
-    if not rec:
+    # Look up by email only and compare in constant time so neither the
+    # query shape nor the comparison leaks code digits; expired leftovers
+    # are reaped by the TTL index.
+    rec = await db["otp"].find_one({"email": req.email}, sort=[("created_at", -1)])
+    if not rec or not hmac.compare_digest(rec.get("code", "").encode(), req.code.encode()):
         raise HTTPException(status_code=400, detail="Kode OTP tidak valid")
     if int(time.time()) > int(rec.get("expires_at", 0)):
-        db["otp"].delete_many({"email": req.email})
         raise HTTPException(status_code=400, detail="Kode OTP kedaluwarsa")
-    db["otp"].delete_many({"email": req.email})
+    await db["otp"].delete_one({"_id": rec["_id"]})
     token = create_access_token(req.email)
     return {"access_token": token, "token_type": "bearer", "email": req.email}
 
@@ -155,30 +276,35 @@ def me(email: str = Depends(get_current_user)):
 
 # ----------------- Stripe Checkout -----------------
 @app.post("/api/checkout/session")
-def create_checkout_session(payload: CheckoutSessionRequest):
+async def create_checkout_session(payload: CheckoutSessionRequest):
     if not stripe.api_key:
         raise HTTPException(status_code=500, detail="Stripe not configured")
+    if STRIPE_PRICE_ID:
+        line_item = {"price": STRIPE_PRICE_ID, "quantity": 1}
+    else:
+        # Fallback for environments without a provisioned Price object.
+        line_item = {
+            "price_data": {
+                "currency": "idr",
+                "product_data": {
+                    "name": "Langganan ASN Swap",
+                    "description": "Akses fitur pencarian, match, dan chat"
+                },
+                "unit_amount": 5000000,
+                "recurring": {"interval": "month"}
+            },
+            "quantity": 1,
+        }
     try:
-        session = stripe.checkout.Session.create(
+        # Stripe's client is synchronous; keep it off the event loop.
+        session = await run_in_threadpool(
+            stripe.checkout.Session.create,
             mode="subscription",
             payment_method_types=["card"],
             customer_email=payload.email,
-            line_items=[
-                {
-                    "price_data": {
-                        "currency": "idr",
-                        "product_data": {
-                            "name": "Langganan ASN Swap",
-                            "description": "Akses fitur pencarian, match, dan chat"
-                        },
-                        "unit_amount": 5000000,
-                        "recurring": {"interval": "month"}
-                    },
-                    "quantity": 1,
-                }
-            ],
-            success_url=os.getenv("FRONTEND_URL", "http://localhost:3000") + "/success?session_id={CHECKOUT_SESSION_ID}",
-            cancel_url=os.getenv("FRONTEND_URL", "http://localhost:3000") + "/",
+            line_items=[line_item],
+            success_url=CHECKOUT_SUCCESS_URL,
+            cancel_url=CHECKOUT_CANCEL_URL,
         )
         return {"id": session.id, "url": session.url}
     except Exception as e:
@@ -187,72 +313,115 @@ def create_checkout_session(payload: CheckoutSessionRequest):
 
 # ----------------- Profiles -----------------
 @app.post("/api/profile", response_model=dict)
-def create_or_update_profile(profile: ProfileCreateRequest, email: str = Depends(get_current_user)):
+async def create_or_update_profile(profile: ProfileCreateRequest, email: str = Depends(get_current_user)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
     # Enforce email from token
-    data = profile.model_dump()
+    data = profile.model_dump(mode="python", exclude_none=True)
     data["email"] = email
-    existing = db["userprofile"].find_one({"email": email})
-    if existing:
-        db["userprofile"].update_one({"email": email}, {"$set": data})
-        return {"status": "updated"}
-    else:
-        create_document("userprofile", data)
-        return {"status": "created"}
+    # Denormalized lowercase copies keep exact-match search on a plain index.
+    for field in SEARCH_FIELDS:
+        data[field + "_lc"] = data[field].lower().strip()
+    # Single atomic upsert: one round-trip, no check-then-write race.
+    now = datetime.now(timezone.utc)
+    data["updated_at"] = now
+    res = await db["userprofile"].update_one(
+        {"email": email},
+        {"$set": data, "$setOnInsert": {"created_at": now}},
+        upsert=True,
+    )
+    await invalidate_profile_cache(email)
+    return {"status": "created" if res.upserted_id else "updated"}
 
 
 @app.get("/api/profile/{email}")
-def get_profile(email: str):
+async def get_profile(email: str):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    doc = db["userprofile"].find_one({"email": email}, {"_id": 0})
+    if redis is not None:
+        cached = await redis.get(f"profile:{email}")
+        if cached:
+            return orjson.loads(cached)
+    doc = await db["userprofile"].find_one({"email": email}, PROFILE_DETAIL_PROJECTION)
     if not doc:
         raise HTTPException(status_code=404, detail="Profile not found")
+    if redis is not None:
+        await redis.set(f"profile:{email}", orjson.dumps(doc), ex=PROFILE_CACHE_TTL)
     return doc
 
 
 # ----------------- Search & Match -----------------
 @app.get("/api/search")
-def search_profiles(
+async def search_profiles(
     desired_region: Optional[str] = Query(None, description="Cari user yang menginginkan daerah ini"),
     current_region: Optional[str] = Query(None, description="Filter berdasarkan daerah kerja saat ini"),
     agency: Optional[str] = Query(None, description="Filter instansi"),
+    exact: bool = Query(True, description="Exact match (indexed); false untuk prefix match"),
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0),
 ):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    q = {}
-    if desired_region:
-        q["desired_region"] = {"$regex": desired_region, "$options": "i"}
-    if current_region:
-        q["current_region"] = {"$regex": current_region, "$options": "i"}
-    if agency:
-        q["agency"] = {"$regex": agency, "$options": "i"}
-    results = list(db["userprofile"].find(q, {"_id": 0}))
-    return {"results": results}
+    supplied = {
+        field: value
+        for field, value in zip(SEARCH_FIELDS, (desired_region, current_region, agency))
+        if value
+    }
+    if supplied and exact:
+        # $eq against the lowercased copies: a straight B-tree seek,
+        # cheaper than any regex or text-index plan.
+        q = {field + "_lc": value.lower().strip() for field, value in supplied.items()}
+        cursor = db["userprofile"].find(q, PROFILE_LIST_PROJECTION)
+    elif supplied:
+        # Anchored prefix regexes on the lowercased copies; ^-anchoring
+        # turns each match into a range scan on the _lc B-tree indexes,
+        # and lowercasing the input keeps matching case-insensitive.
+        q = {
+            field + "_lc": {"$regex": "^" + re.escape(value.lower().strip())}
+            for field, value in supplied.items()
+        }
+        cursor = db["userprofile"].find(q, PROFILE_LIST_PROJECTION)
+    else:
+        cursor = db["userprofile"].find({}, PROFILE_LIST_PROJECTION)
+    return stream_json_array(cursor.skip(offset).limit(limit), "results")
 
 
 # ----------------- Chat -----------------
 @app.post("/api/chat/send")
-def send_message(body: SendMessageRequest, email: str = Depends(get_current_user)):
+async def send_message(body: SendMessageRequest, email: str = Depends(get_current_user)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    create_document("message", {"from_email": email, "to_email": body.to_email, "content": body.content, "read": False})
+    await create_document("message", {
+        "from_email": email,
+        "to_email": body.to_email,
+        "conversation_key": conversation_key(email, body.to_email),
+        "content": body.content,
+        "read": False,
+    })
     return {"status": "sent"}
 
 
 @app.get("/api/chat/history")
-def get_history(with_email: EmailStr, email: str = Depends(get_current_user)):
+async def get_history(
+    with_email: EmailStr,
+    email: str = Depends(get_current_user),
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = Query(None, description="Message id; return messages older than this"),
+):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    a = email
-    b = with_email
-    conv = list(db["message"].find({
-        "$or": [
-            {"from_email": a, "to_email": b},
-            {"from_email": b, "to_email": a}
-        ]
-    }, {"_id": 0}).sort("created_at", 1))
+    q = {"conversation_key": conversation_key(email, with_email)}
+    if before:
+        # Keyset pagination: ObjectIds are insertion-ordered, so walking
+        # _id backwards pages through history without an expensive skip.
+        try:
+            q["_id"] = {"$lt": ObjectId(before)}
+        except InvalidId:
+            raise HTTPException(status_code=400, detail="Invalid 'before' cursor")
+    conv = await db["message"].find(q).sort("_id", -1).limit(limit).to_list(length=limit)
+    conv.reverse()
+    for doc in conv:
+        doc["_id"] = str(doc["_id"])
     return {"messages": conv}
 
 
@@ -263,31 +432,37 @@ class AdminVerifyRequest(BaseModel):
 
 
 @app.get("/api/admin/users")
-def admin_list_users():
+async def admin_list_users(limit: int = Query(50, ge=1, le=200), offset: int = Query(0, ge=0)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    users = list(db["userprofile"].find({}, {"_id": 0}))
-    return {"users": users}
+    cursor = db["userprofile"].find({}, PROFILE_LIST_PROJECTION).skip(offset).limit(limit)
+    return stream_json_array(cursor, "users")
 
 
 @app.post("/api/admin/verify")
-def admin_verify(req: AdminVerifyRequest):
+async def admin_verify(req: AdminVerifyRequest):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    db["userprofile"].update_one({"email": req.email}, {"$set": {"is_verified": req.verified}})
+    await db["userprofile"].update_one({"email": req.email}, {"$set": {"is_verified": req.verified}})
+    await invalidate_profile_cache(req.email)
     return {"status": "ok"}
 
 
 @app.delete("/api/admin/users/{email}")
-def admin_delete(email: str):
+async def admin_delete(email: str):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    db["userprofile"].delete_one({"email": email})
-    db["message"].delete_many({"$or": [{"from_email": email}, {"to_email": email}]})
+    # Run the cascade concurrently so the admin pays one round-trip, not two.
+    await asyncio.gather(
+        db["userprofile"].delete_one({"email": email}),
+        db["message"].delete_many({"$or": [{"from_email": email}, {"to_email": email}]}),
+    )
+    await invalidate_profile_cache(email)
     return {"status": "deleted"}
 
 
 if __name__ == "__main__":
+    # Dev convenience only; production runs under Gunicorn (see start_server.sh).
     import uvicorn
     port = int(os.getenv("PORT", 8000))
     uvicorn.run(app, host="0.0.0.0", port=port)